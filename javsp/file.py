@@ -6,6 +6,9 @@ import ctypes
 import logging
 import itertools
 import json
+import string
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from sys import platform
 from typing import List
 
@@ -23,7 +26,7 @@ from javsp.datatype import Movie
 logger = logging.getLogger(__name__)
 failed_items = []
 
-_DUPLICATE_SUFFIXES = ('-UC', '-C')
+_DUPLICATE_SUFFIX_PATTERN = re.compile(r'(?:-UC|-C)+$')
 _PLACEHOLDER_PATTERN = re.compile(r'\{([^}]+)\}')
 
 
@@ -32,20 +35,12 @@ def _normalize_duplicate_avid(value: str | None) -> str | None:
     if not value:
         return None
     avid = value.strip().upper()
-    # 循环移除所有后缀（处理重复后缀情况）
-    while True:
-        removed = False
-        for suffix in _DUPLICATE_SUFFIXES:
-            if avid.endswith(suffix):
-                avid = avid[:-len(suffix)]
-                removed = True
-                break
-        if not removed:
-            break
-    return avid
+    # 一次性移除末尾所有（可能重复的）后缀
+    return _DUPLICATE_SUFFIX_PATTERN.sub('', avid) or None
 
 
-def _split_output_pattern(pattern: str) -> tuple[str, list[str]]:
+@lru_cache(maxsize=64)
+def _split_output_pattern(pattern: str) -> tuple[str, tuple[str, ...]]:
     """将路径模板拆分为纯文本前缀和剩余的段列表"""
     normalized = pattern.replace('\\', '/').strip()
     first_placeholder = normalized.find('{')
@@ -61,10 +56,11 @@ def _split_output_pattern(pattern: str) -> tuple[str, list[str]]:
             base = normalized[:last_sep]
             tail = normalized[last_sep+1:]
     base = base.rstrip('/')
-    segments = [seg for seg in tail.split('/') if seg]
+    segments = tuple(seg for seg in tail.split('/') if seg)
     return base, segments
 
 
+@lru_cache(maxsize=64)
 def _compile_segment_regex(segment: str) -> re.Pattern:
     """将路径段转换为匹配同级目录名称的正则表达式"""
     parts = []
@@ -83,20 +79,25 @@ def _compile_segment_regex(segment: str) -> re.Pattern:
     return re.compile(rf'^{expr}$')
 
 
+@lru_cache(maxsize=8)
+def _prepare_output_pattern(pattern: str) -> tuple[str, tuple[re.Pattern, ...]]:
+    """解析路径模板，返回起始文件夹和各路径段对应的正则表达式"""
+    base_literal, segments = _split_output_pattern(pattern)
+    base_dir = base_literal or '.'
+    base_dir = os.path.normpath(base_dir.replace('/', os.sep))
+    compiled_segments = tuple(_compile_segment_regex(seg) for seg in segments)
+    return base_dir, compiled_segments
+
+
 def get_existing_summary_avids(pattern: str | None = None) -> set[str]:
     """根据整理路径模板收集#整理完成目录下已有的番号集合"""
     if pattern is None:
         pattern = Cfg().summarizer.path.output_folder_pattern
     if '{num}' not in pattern:
         return set()
-    base_literal, segments = _split_output_pattern(pattern)
-    if not segments:
+    base_dir, compiled_segments = _prepare_output_pattern(pattern)
+    if not compiled_segments or not os.path.isdir(base_dir):
         return set()
-    base_dir = base_literal or '.'
-    base_dir = os.path.normpath(base_dir.replace('/', os.sep))
-    if not os.path.isdir(base_dir):
-        return set()
-    compiled_segments = [_compile_segment_regex(seg) for seg in segments]
     candidates = [(base_dir, {})]
     for regex in compiled_segments:
         next_candidates = []
@@ -138,6 +139,90 @@ def movie_duplicate_key(movie: Movie) -> str | None:
     return _normalize_duplicate_avid(avid + movie.attr_str)
 
 
+@lru_cache(maxsize=8)
+def _ignored_pattern(patterns: tuple[str, ...]) -> re.Pattern:
+    """编译扫描时要忽略的文件夹名称的正则表达式（按模式列表缓存）"""
+    return re.compile('|'.join(patterns))
+
+
+def _list_dir(path: str | bytes, ignore_pattern: re.Pattern | None = None, skip_nfo: bool = False):
+    """列出文件夹内的文件(DirEntry)、需要继续扫描的子文件夹（未指定ignore_pattern时不忽略任何文件夹），以及文件夹内是否有nfo文件"""
+    files, subdirs = [], []
+    has_nfo = False
+    nfo_ext = b'.nfo' if isinstance(path, bytes) else '.nfo'
+    try:
+        scandir_it = os.scandir(path)
+    except OSError:
+        return files, subdirs, has_nfo
+    with scandir_it:
+        for entry in scandir_it:
+            # 在读取文件夹的同时检查nfo文件，避免在上级文件夹中再单独读取一遍
+            if skip_nfo and not has_nfo and entry.name.lower().endswith(nfo_ext):
+                has_nfo = True
+            if not entry.is_dir():
+                files.append(entry)
+                continue
+            # 与os.walk一致，不进入指向文件夹的符号链接
+            if entry.is_symlink():
+                continue
+            if ignore_pattern and ignore_pattern.match(os.fsdecode(entry.name)):
+                continue
+            subdirs.append(entry.path)
+    return files, subdirs, has_nfo
+
+
+def _scan_dir(path: str | bytes, ignore_pattern: re.Pattern | None = None, skip_nfo: bool = False, is_root: bool = True):
+    """递归扫描文件夹，逐个返回其中的文件(所在文件夹, DirEntry)，子文件夹在当前文件夹的文件之后处理"""
+    files, subdirs, has_nfo = _list_dir(path, ignore_pattern, skip_nfo)
+    # 移除有nfo的文件夹（扫描起始文件夹本身不受影响）
+    if has_nfo and not is_root:
+        print(f"skip file {os.fsdecode(os.path.basename(path))}")
+        return
+    for entry in files:
+        yield path, entry
+    for subdir in subdirs:
+        yield from _scan_dir(subdir, ignore_pattern, skip_nfo, is_root=False)
+
+
+def _scan_dir_parallel(path: str | bytes, ignore_pattern: re.Pattern, skip_nfo: bool, max_workers: int = 8):
+    """与_scan_dir相同，但使用线程池并行扫描各个一级子文件夹（用于延迟较高的网络驱动器）"""
+    files, subdirs, _ = _list_dir(path, ignore_pattern, skip_nfo)
+    for entry in files:
+        yield path, entry
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 生成器在工作线程中由list()驱动完成扫描，主线程按提交顺序汇总结果以保持与单线程扫描相同的顺序
+        futures = [executor.submit(list, _scan_dir(i, ignore_pattern, skip_nfo, is_root=False)) for i in subdirs]
+        for future in futures:
+            yield from future.result()
+
+
+@lru_cache(maxsize=256)
+def _slice_pattern(prefix: str) -> re.Pattern:
+    """构造用于提取分片信息的正则表达式（按文件名公共前缀缓存）"""
+    return re.compile(re_escape(prefix) + r'\s*([a-z\d])\s*', flags=re.I)
+
+
+_SLICE_CHARS = frozenset(string.digits + string.ascii_lowercase)
+def _detect_single_char_slices(basenames: List[str], prefix: str) -> List[str] | None:
+    """若各文件名仅在公共前缀之后的一个字符上不同（且都是数字或字母），返回该位置的小写字符列表，否则返回None"""
+    pos = len(prefix)
+    length = len(basenames[0])
+    if pos >= length:
+        return None
+    tail = basenames[0][pos+1:]
+    for name in basenames:
+        if len(name) != length or name[pos+1:] != tail:
+            return None
+    slices = [name[pos].lower() for name in basenames]
+    if not all(i in _SLICE_CHARS for i in slices):
+        return None
+    return slices
+
+
+# Windows上的宽字符API原生返回str，其余平台上文件名需要解码，扫描时先使用bytes路径
+_SCAN_BYTES_PATH = platform != 'win32'
+
+
 def scan_movies(root: str) -> List[Movie]:
     """获取文件夹内的所有影片的列表（自动探测同一文件夹内的分片）"""
     # 由于实现的限制: 
@@ -145,45 +230,51 @@ def scan_movies(root: str) -> List[Movie]:
     # 2. 允许分片间的编号有公共的前导符（如编号01, 02, 03），因为求prefix时前导符也会算进去
 
     # 扫描所有影片文件并获取它们的番号
-    dic = {}    # avid: [abspath1, abspath2...]
+    dic = {}    # avid: [(dirpath1, basename1), (dirpath2, basename2)...]
     small_videos = {}
-    ignore_folder_name_pattern = re.compile('|'.join(Cfg().scanner.ignored_folder_name_pattern))
-    for dirpath, dirnames, filenames in os.walk(root):
-        for name in dirnames.copy():
-            if ignore_folder_name_pattern.match(name):
-                dirnames.remove(name)
-            # 移除有nfo的文件夹
-            if Cfg().scanner.skip_nfo_dir:
-                if any(file.lower().endswith(".nfo") for file in os.listdir(os.path.join(dirpath, name)) if isinstance(file, str)):
-                    print(f"skip file {name}")
-                    dirnames.remove(name)
-
-        for file in filenames:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in Cfg().scanner.filename_extensions:
-                fullpath = os.path.join(dirpath, file)
-                # 忽略小于指定大小的文件
-                filesize = os.path.getsize(fullpath)
-                if filesize < Cfg().scanner.minimum_size:
-                    small_videos.setdefault(file, []).append(fullpath)
-                    continue
-                dvdid = get_id(fullpath)
-                cid = get_cid(fullpath)
-                # 如果文件名能匹配到cid，那么将cid视为有效id，因为此时dvdid多半是错的
-                avid = cid if cid else dvdid
-                if avid:
-                    if avid in dic:
-                        dic[avid].append(fullpath)
-                    else:
-                        dic[avid] = [fullpath]
+    dvdids = {}     # abspath: dvdid，供最后转换数据格式时复用
+    scanner = Cfg().scanner
+    ignore_folder_name_pattern = _ignored_pattern(tuple(scanner.ignored_folder_name_pattern))
+    exts = frozenset(i.lower() for i in scanner.filename_extensions)
+    min_size = scanner.minimum_size
+    skip_nfo = scanner.skip_nfo_dir
+    splitext = os.path.splitext
+    # 非Windows平台上以bytes路径扫描，仅对后缀匹配的影片文件解码文件名
+    scan_root = root
+    if _SCAN_BYTES_PATH:
+        scan_root = os.fsencode(root)
+        exts = frozenset(os.fsencode(i) for i in exts)
+    # 网络驱动器上每次读取文件夹的延迟较高，使用多线程并行扫描
+    scan_dir = _scan_dir_parallel if is_remote_drive(root) else _scan_dir
+    for dirpath, entry in scan_dir(scan_root, ignore_folder_name_pattern, skip_nfo):
+        file = entry.name
+        ext = splitext(file)[1].lower()
+        if ext in exts:
+            if _SCAN_BYTES_PATH:
+                dirpath, file = os.fsdecode(dirpath), os.fsdecode(file)
+            fullpath = os.path.join(dirpath, file)
+            # 忽略小于指定大小的文件（未设置大小限制时无需获取文件大小）
+            if min_size > 0 and entry.stat().st_size < min_size:
+                small_videos.setdefault(file, []).append((dirpath, file))
+                continue
+            dvdid = get_id(fullpath)
+            dvdids[fullpath] = dvdid
+            cid = get_cid(fullpath)
+            # 如果文件名能匹配到cid，那么将cid视为有效id，因为此时dvdid多半是错的
+            avid = cid if cid else dvdid
+            if avid:
+                if avid in dic:
+                    dic[avid].append((dirpath, file))
                 else:
-                    fail = Movie('无法识别番号')
-                    fail.files = [fullpath]
-                    failed_items.append(fail)
-                    logger.error(f"无法提取影片番号: '{fullpath}'")
+                    dic[avid] = [(dirpath, file)]
+            else:
+                fail = Movie('无法识别番号')
+                fail.files = [fullpath]
+                failed_items.append(fail)
+                logger.error(f"无法提取影片番号: '{fullpath}'")
     # 多分片影片容易有文件大小低于阈值的子片，进行特殊处理
     has_avid = {}
-    for name in list(small_videos.keys()):
+    for name in tuple(small_videos):
         dvdid = get_id(name)
         cid = get_cid(name)
         avid = cid if cid else dvdid
@@ -193,7 +284,7 @@ def scan_movies(root: str) -> List[Movie]:
             has_avid[name] = avid
     # 对于前面忽略的视频生成一个简单的提示
     small_videos = {k:sorted(v) for k,v in sorted(small_videos.items())}
-    skipped_files = list(itertools.chain(*small_videos.values()))
+    skipped_files = [os.path.join(*i) for i in itertools.chain(*small_videos.values())]
     skipped_cnt = len(skipped_files)
     if skipped_cnt > 0:
         if len(has_avid) > 0:
@@ -202,68 +293,82 @@ def scan_movies(root: str) -> List[Movie]:
             logger.info(f"跳过了{skipped_cnt}个小于指定大小的视频文件")
         logger.debug('跳过的视频文件如下:\n' + '\n'.join(skipped_files))
     # 检查是否有多部影片对应同一个番号
-    non_slice_dup = {}  # avid: [abspath1, abspath2...]
-    for avid, files in dic.copy().items():
+    non_slice_dup = {}  # avid: [(dirpath1, basename1), (dirpath2, basename2)...]
+    invalid_avids = []  # 遍历结束后再从dic中移除，避免遍历时修改字典
+    for avid, files in dic.items():
         # 一一对应的直接略过
         if len(files) == 1:
             continue
-        dirs = set([os.path.split(i)[0] for i in files])
+        # 提取分片信息（如果正则替换成功，只会剩下单个小写字符）。相关变量都要使用同样的列表生成顺序
+        dirs = {folder for folder, _ in files}
+        basenames = [basename for _, basename in files]
         # 不同位置的多部影片有相同番号时，略过并报错
         if len(dirs) > 1:
             non_slice_dup[avid] = files
-            del dic[avid]
+            invalid_avids.append(avid)
             continue
-        # 提取分片信息（如果正则替换成功，只会剩下单个小写字符）。相关变量都要使用同样的列表生成顺序
-        basenames = [os.path.basename(i) for i in files]
+        # 文件名仅在单个位置上不同时，直接取该位置的字符作为分片信息，无需构造正则
         prefix = os.path.commonprefix(basenames)
-        try:
-            pattern_expr = re_escape(prefix) + r'\s*([a-z\d])\s*'
-            pattern = re.compile(pattern_expr, flags=re.I)
-        except re.error:
-            logger.debug(f"正则识别影片分片信息时出错: '{pattern_expr}'")
-            del dic[avid]
-            continue
-        remaining = [pattern.sub(r'\1', i).lower() for i in basenames]
-        postfixes = [i[1:] for i in remaining]
-        slices = [i[0] for i in remaining]
-        # 如果有不同的后缀，说明有文件名不符合正则表达式条件（没有发生替换或不带分片信息）
-        if (len(set(postfixes)) != 1
-            # remaining为初步提取的分片信息，不允许有重复值
-            or len(slices) != len(set(slices))):
-            logger.debug(f"无法识别分片信息: {prefix=}, {remaining=}")
+        slices = _detect_single_char_slices(basenames, prefix)
+        if slices is None:
+            try:
+                pattern = _slice_pattern(prefix)
+            except re.error:
+                logger.debug(f"正则识别影片分片信息时出错: {prefix=}")
+                invalid_avids.append(avid)
+                continue
+            remaining, slices, postfixes = [], [], []
+            for i in basenames:
+                r = pattern.sub(r'\1', i).lower()
+                remaining.append(r)
+                slices.append(r[0])
+                postfixes.append(r[1:])
+            # 如果有不同的后缀，说明有文件名不符合正则表达式条件（没有发生替换或不带分片信息）
+            if len(set(postfixes)) != 1:
+                logger.debug(f"无法识别分片信息: {prefix=}, {remaining=}")
+                non_slice_dup[avid] = files
+                invalid_avids.append(avid)
+                continue
+        # 初步提取的分片信息不允许有重复值
+        if len(slices) != len(set(slices)):
+            logger.debug(f"分片信息存在重复: {basenames=}, {slices=}")
             non_slice_dup[avid] = files
-            del dic[avid]
+            invalid_avids.append(avid)
             continue
         # 影片编号必须从 0/1/a 开始且编号连续
-        sorted_slices = sorted(slices)
-        first, last = sorted_slices[0], sorted_slices[-1]
-        if (first not in ('0', '1', 'a')) or (ord(last) != (ord(first)+len(sorted_slices)-1)):
-            logger.debug(f"无效的分片起始编号或分片编号不连续: {sorted_slices=}")
+        # 分片编号无重复，因此编号连续时只需检查最小和最大值
+        first, last = min(slices), max(slices)
+        if (first not in ('0', '1', 'a')) or (ord(last) != (ord(first)+len(slices)-1)):
+            logger.debug(f"无效的分片起始编号或分片编号不连续: {slices=}")
             non_slice_dup[avid] = files
-            del dic[avid]
+            invalid_avids.append(avid)
             continue
         # 生成最终的分片信息
-        mapped_files = [files[slices.index(i)] for i in sorted_slices]
+        slice_index = {c: i for i, c in enumerate(slices)}
+        mapped_files = [files[slice_index[chr(ord(first)+k)]] for k in range(len(slices))]
         dic[avid] = mapped_files
+    for avid in invalid_avids:
+        del dic[avid]
 
     # 汇总输出错误提示信息
     msg = ''
     for avid, files in non_slice_dup.items():
         msg += f'{avid}: \n'
         for f in files:
-            msg += ('  ' + os.path.relpath(f, root) + '\n')
+            msg += ('  ' + os.path.relpath(os.path.join(*f), root) + '\n')
     if msg:
         logger.error("下列番号对应多部影片文件且不符合分片规则，已略过整理，请手动处理后重新运行脚本: \n" + msg)
     # 转换数据的组织格式
     movies: List[Movie] = []
     for avid, files in dic.items():
+        files = [os.path.join(*i) for i in files]
         src = guess_av_type(avid)
         if src != 'cid':
             mov = Movie(avid)
         else:
             mov = Movie(cid=avid)
             # 即使初步识别为cid，也存储dvdid以供误识别时退回到dvdid模式进行抓取
-            mov.dvdid = get_id(files[0])
+            mov.dvdid = dvdids[files[0]] if files[0] in dvdids else get_id(files[0])
         mov.files = files
         mov.data_src = src
         logger.debug(f'影片数据源类型: {avid}: {src}')
@@ -277,32 +382,45 @@ def get_failed_when_scan():
 
 
 _PARDIR_REPLACE = re.compile(r'\.{2,}')
+# 非法字符列表 https://stackoverflow.com/a/31976060/6415337
+if platform == 'win32':
+    # http://www.unicode.org/Public/security/latest/confusables.txt
+    _ILLEGAL_CHARS_TABLE = str.maketrans({'<': '❮',
+                                          '>': '❯',
+                                          ':': '：',
+                                          '"': '″',
+                                          '/': '／',
+                                          '\\': '＼',
+                                          '|': '｜',
+                                          '?': '？',
+                                          '*': '꘎'})
+elif platform == "darwin":  # MAC OS X
+    _ILLEGAL_CHARS_TABLE = str.maketrans({':': '：'})
+else:   # 其余都当做Linux处理
+    _ILLEGAL_CHARS_TABLE = str.maketrans({'/': '／'})
+
+
 def replace_illegal_chars(name):
     """将不能用于文件名的字符替换为形近的字符"""
-    # 非法字符列表 https://stackoverflow.com/a/31976060/6415337
-    if platform == 'win32': 
-        # http://www.unicode.org/Public/security/latest/confusables.txt
-        charmap = {'<': '❮',
-                   '>': '❯',
-                   ':': '：',
-                   '"': '″',
-                   '/': '／',
-                   '\\': '＼',
-                   '|': '｜',
-                   '?': '？',
-                   '*': '꘎'}
-        for c, rep in charmap.items():
-            name = name.replace(c, rep)
-    elif platform == "darwin":  # MAC OS X
-        name = name.replace(':', '：')
-    else:   # 其余都当做Linux处理
-        name = name.replace('/', '／')
+    name = name.translate(_ILLEGAL_CHARS_TABLE)
     # 处理连续多个英文句点.
-    if os.pardir in name:
+    if '..' in name:
         name = _PARDIR_REPLACE.sub('…', name)
     return name
 
 
+if platform == 'win32':
+    _GetDriveTypeW = ctypes.windll.kernel32.GetDriveTypeW
+    _GetDriveTypeW.argtypes = [ctypes.c_wchar_p]
+    _GetDriveTypeW.restype = ctypes.c_uint
+
+
+@lru_cache(maxsize=32)
+def _drive_type(drive: str) -> int:
+    """获取驱动器类型（进程内驱动器类型基本不会变化，因此缓存结果）"""
+    return _GetDriveTypeW(drive)
+
+
 def is_remote_drive(path: str):
     """判断一个路径是否为远程映射到本地"""
     #TODO: 当前仅支持Windows平台
@@ -310,8 +428,7 @@ def is_remote_drive(path: str):
         return False
     DRIVE_REMOTE = 0x4
     drive = os.path.splitdrive(os.path.abspath(path))[0] + os.sep
-    result = ctypes.windll.kernel32.GetDriveTypeW(drive)
-    return result == DRIVE_REMOTE
+    return _drive_type(drive) == DRIVE_REMOTE
 
 
 def get_remaining_path_len(path):
@@ -319,11 +436,13 @@ def get_remaining_path_len(path):
     #TODO: 支持不同的操作系统
     fullpath = os.path.abspath(path)
     # Windows: If the length exceeds ~256 characters, you will be able to see the path/files via Windows/File Explorer, but may not be able to delete/move/rename these paths/files
-    length = len(fullpath.encode('utf-8')) if Cfg().summarizer.path.length_by_byte else len(fullpath)
-    remaining = Cfg().summarizer.path.length_maximum - length
+    path_cfg = Cfg().summarizer.path
+    length = len(fullpath.encode('utf-8')) if path_cfg.length_by_byte else len(fullpath)
+    remaining = path_cfg.length_maximum - length
     return remaining
 
 
+_SIZE_UNITS = ('', 'Ki', 'Mi', 'Gi', 'Ti')
 def get_fmt_size(file_or_size) -> str:
     """获取格式化后的文件大小
 
@@ -337,28 +456,31 @@ def get_fmt_size(file_or_size) -> str:
         size = file_or_size
     else:
         size = os.path.getsize(file_or_size)
-    for unit in ['','Ki','Mi','Gi','Ti']:
-        # 1023.995: to avoid rounding bug when format str, e.g. 1048571 -> 1024.0 KiB
-        if abs(size) < 1023.995:
-            return f"{size:3.2f} {unit}B"
+    # 由整数位长直接确定单位，避免循环除法
+    idx = min(max(int(abs(size)).bit_length() - 1, 0) // 10, len(_SIZE_UNITS) - 1)
+    size /= 1 << (idx * 10)
+    # 1023.995: to avoid rounding bug when format str, e.g. 1048571 -> 1024.0 KiB
+    if abs(size) >= 1023.995 and idx < len(_SIZE_UNITS) - 1:
+        idx += 1
         size /= 1024.0
+    return f"{size:3.2f} {_SIZE_UNITS[idx]}B"
 
 
 _sub_files = {}
-SUB_EXTENSIONS = ('.srt', '.ass')
+SUB_EXTENSIONS = frozenset(('.srt', '.ass'))
 def find_subtitle_in_dir(folder: str, dvdid: str):
     """在folder内寻找是否有匹配dvdid的字幕"""
     folder_data = _sub_files.get(folder)
     if folder_data is None:
         # 此文件夹从未检查过时
         folder_data = {}
-        for dirpath, dirnames, filenames in os.walk(folder):
-            for file in filenames:
-                basename, ext = os.path.splitext(file)
-                if ext in SUB_EXTENSIONS:
-                    match_id = get_id(basename)
-                    if match_id:
-                        folder_data[match_id.upper()] = os.path.join(dirpath, file)
+        for _, entry in _scan_dir(folder):
+            basename, ext = os.path.splitext(entry.name)
+            # 先按后缀过滤，仅对字幕文件提取番号
+            if ext.lower() in SUB_EXTENSIONS:
+                match_id = get_id(basename)
+                if match_id:
+                    folder_data[match_id.upper()] = entry.path
         _sub_files[folder] = folder_data
     sub_file = folder_data.get(dvdid.upper())
     return sub_file
@@ -7,7 +7,8 @@ from shutil import rmtree
 
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from javsp.file import scan_movies, get_existing_summary_avids, movie_duplicate_key
+from javsp.file import scan_movies, get_existing_summary_avids, movie_duplicate_key, get_fmt_size, replace_illegal_chars
+from javsp.file import _scan_dir, _scan_dir_parallel, _ignored_pattern
 from javsp.datatype import Movie
 
 
@@ -229,6 +230,26 @@ def test_scan_movies__n_video_with_ad(prepare_files):
     assert all(len(i.files) == 1 for i in movies)
 
 
+# 忽略指定名称的文件夹以及含有nfo文件的子文件夹（扫描的根文件夹内有nfo时不受影响）
+@pytest.mark.parametrize('files', [{'ABC-123.mp4': DEFAULT_SIZE, '#整理完成/DEF-456.mp4': DEFAULT_SIZE,
+                                    'GHI-789/GHI-789.mp4': DEFAULT_SIZE, 'GHI-789/GHI-789.nfo': 1024,
+                                    'root.nfo': 1024}])
+def test_scan_movies__skip_folders(prepare_files):
+    movies = scan_movies(tmp_folder)
+    assert len(movies) == 1
+    assert movies[0].dvdid == 'ABC-123'
+
+
+# 并行扫描的结果及顺序应与单线程扫描一致
+@pytest.mark.parametrize('files', [('ABC-123.mp4', 'a/DEF-456.mp4', 'a/b/GHI-789.mp4', 'c/JKL-012.mp4', '#整理完成/MNO-345.mp4')])
+def test_scan_dir_parallel(prepare_files):
+    pattern = _ignored_pattern(('^#整理完成$',))
+    serial = [(d, e.name) for d, e in _scan_dir(tmp_folder, pattern, True)]
+    parallel = [(d, e.name) for d, e in _scan_dir_parallel(tmp_folder, pattern, True)]
+    assert len(serial) == 4
+    assert serial == parallel
+
+
 def test_get_existing_summary_avids(tmp_path):
     base = tmp_path / '#整理完成'
     (base / 'ActressA' / '[ABC-123] Title A').mkdir(parents=True)
@@ -243,3 +264,15 @@ def test_movie_duplicate_key_handles_suffix():
     movie = Movie('ABC-123')
     movie.files = ['ABC-123-C.mp4']
     assert movie_duplicate_key(movie) == 'ABC-123'
+
+
+@pytest.mark.parametrize('size, expected', [(0, '0.00 B'), (1023, '1023.00 B'), (1024, '1.00 KiB'),
+                                            (1048571, '1.00 MiB'), (DEFAULT_SIZE, '512.00 MiB'), (5*2**30, '5.00 GiB')])
+def test_get_fmt_size(size, expected):
+    assert get_fmt_size(size) == expected
+
+
+@pytest.mark.parametrize('name, expected', [('ABC-123', 'ABC-123'), ('a.b', 'a.b'), ('a..b', 'a…b'),
+                                            ('a.....b..', 'a…b…'), ('...', '…')])
+def test_replace_illegal_chars__pardir(name, expected):
+    assert replace_illegal_chars(name) == expected